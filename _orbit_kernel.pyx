@@ -0,0 +1,134 @@
+#     Solar system simulator. Copyright (c) 2017 Mads M. Hansen
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+
+"""Native OpenMP kernel for the accelerations of the solar system"""
+
+from cython.parallel cimport prange
+from libc.math cimport pow, sqrtf
+import numpy as np
+
+
+cdef extern from "_orbit_simd.h" nogil:
+    int ORBIT_HAVE_AVX2
+    void accel_block4(Py_ssize_t i, Py_ssize_t n, const double *x,
+                      const double *y, const double *z, const double *gm,
+                      double *out)
+    void accel_block8_f32(Py_ssize_t i, Py_ssize_t n, const double *x,
+                          const double *y, const double *z, const float *gm,
+                          double *out)
+
+
+# True when the kernel was compiled with AVX2 intrinsics
+have_avx2 = bool(ORBIT_HAVE_AVX2)
+
+
+cdef inline void accel_row(Py_ssize_t i, Py_ssize_t n, double[:, ::1] pos,
+                           double[::1] gm, double[:, ::1] out) noexcept nogil:
+    """Resultant acceleration on the single target body i"""
+
+    cdef Py_ssize_t j, k
+    cdef double ax = 0.0, ay = 0.0, az = 0.0
+    cdef double dx, dy, dz, r2, s
+
+    # A body exerts no acceleration on itself, so step over j == i
+    for k in range(n - 1):
+        j = k + (k >= i)
+
+        dx = pos[j, 0] - pos[i, 0]
+        dy = pos[j, 1] - pos[i, 1]
+        dz = pos[j, 2] - pos[i, 2]
+
+        r2 = dx * dx + dy * dy + dz * dz
+        s = gm[j] * pow(r2, -1.5)
+
+        ax += s * dx
+        ay += s * dy
+        az += s * dz
+
+    out[i, 0] = ax
+    out[i, 1] = ay
+    out[i, 2] = az
+
+
+def compute_accel(double[:, ::1] pos, double[::1] gm, double[:, ::1] out):
+    """Writes the n x 3 resultant accelerations for the positions
+    pos and gravitational parameters gm into out"""
+
+    cdef Py_ssize_t n = pos.shape[0]
+    cdef Py_ssize_t n_blocks = n // 4
+    cdef Py_ssize_t b, i
+
+    # Lay the positions out per axis so four targets fill a SIMD register
+    cdef double[:, ::1] axes = np.ascontiguousarray(np.asarray(pos).T)
+
+    # Every thread owns the rows it writes, so no reduction is needed
+    for b in prange(n_blocks, nogil=True, schedule='static'):
+        accel_block4(4 * b, n, &axes[0, 0], &axes[1, 0], &axes[2, 0],
+                     &gm[0], &out[0, 0])
+
+    # The remaining n % 4 targets one at a time
+    for i in range(4 * n_blocks, n):
+        accel_row(i, n, pos, gm, out)
+
+
+cdef inline void accel_row_f32(Py_ssize_t i, Py_ssize_t n, double[:, ::1] pos,
+                               float[::1] gm, double[:, ::1] out) noexcept nogil:
+    """Resultant acceleration on the single target body i in single precision,
+    from separations formed in double precision"""
+
+    cdef Py_ssize_t j, k
+    cdef float ax = 0.0, ay = 0.0, az = 0.0
+    cdef float dx, dy, dz, inv_r, s
+
+    # A body exerts no acceleration on itself, so step over j == i
+    for k in range(n - 1):
+        j = k + (k >= i)
+
+        dx = <float>(pos[j, 0] - pos[i, 0])
+        dy = <float>(pos[j, 1] - pos[i, 1])
+        dz = <float>(pos[j, 2] - pos[i, 2])
+
+        # GM_j / r^2 times the unit vector keeps the intermediates from
+        # underflowing, which 1 / r^3 does in single precision
+        inv_r = 1.0 / sqrtf(dx * dx + dy * dy + dz * dz)
+        s = gm[j] * (inv_r * inv_r)
+
+        ax += s * (dx * inv_r)
+        ay += s * (dy * inv_r)
+        az += s * (dz * inv_r)
+
+    out[i, 0] = ax
+    out[i, 1] = ay
+    out[i, 2] = az
+
+
+def compute_accel_f32(double[:, ::1] pos, double[::1] gm, double[:, ::1] out):
+    """Single precision variant of compute_accel, eight targets per SIMD block.
+    Takes and returns the same float64 arrays as compute_accel."""
+
+    cdef Py_ssize_t n = pos.shape[0]
+    cdef Py_ssize_t n_blocks = n // 8
+    cdef Py_ssize_t b, i
+
+    cdef double[:, ::1] axes = np.ascontiguousarray(np.asarray(pos).T)
+    cdef float[::1] gm_f32 = np.asarray(gm, dtype=np.float32)
+
+    for b in prange(n_blocks, nogil=True, schedule='static'):
+        accel_block8_f32(8 * b, n, &axes[0, 0], &axes[1, 0], &axes[2, 0],
+                         &gm_f32[0], &out[0, 0])
+
+    for i in range(8 * n_blocks, n):
+        accel_row_f32(i, n, pos, gm_f32, out)
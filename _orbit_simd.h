@@ -0,0 +1,243 @@
+/*
+ *     Solar system simulator. Copyright (c) 2017 Mads M. Hansen
+ *     This program is free software: you can redistribute it and/or modify
+ *     it under the terms of the GNU General Public License as published by
+ *     the Free Software Foundation, either version 3 of the License, or
+ *     (at your option) any later version.
+ *
+ *     This program is distributed in the hope that it will be useful,
+ *     but WITHOUT ANY WARRANTY; without even the implied warranty of
+ *     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *     GNU General Public License for more details.
+ *
+ *     You should have received a copy of the GNU General Public License
+ *     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ *
+ * Accelerations on four consecutive target bodies i, i+1, i+2, i+3 from all
+ * n source bodies. The positions are laid out per axis (x[n], y[n], z[n])
+ * so that the four targets fill one AVX2 register of doubles. The results
+ * are written to rows i to i+3 of the row-major n x 3 array out.
+ *
+ * The single precision variant handles the eight targets i to i+7. It forms
+ * the separations in double precision from the same double positions and
+ * computes the distances and the sums over j in single precision.
+ */
+
+#ifndef ORBIT_SIMD_H
+#define ORBIT_SIMD_H
+
+#include <math.h>
+#include <stddef.h>
+
+#ifdef __AVX2__
+
+#include <immintrin.h>
+
+#define ORBIT_HAVE_AVX2 1
+
+static inline void accel_block4(ptrdiff_t i, ptrdiff_t n,
+                                const double *x, const double *y,
+                                const double *z, const double *gm,
+                                double *out)
+{
+    const __m256d zero = _mm256_setzero_pd();
+    const __m256d xi = _mm256_loadu_pd(&x[i]);
+    const __m256d yi = _mm256_loadu_pd(&y[i]);
+    const __m256d zi = _mm256_loadu_pd(&z[i]);
+    const __m256i lanes = _mm256_setr_epi64x(i, i + 1, i + 2, i + 3);
+
+    __m256d ax = zero, ay = zero, az = zero;
+    double res[3][4];
+    ptrdiff_t j;
+    int l;
+
+    for (j = 0; j < n; j++) {
+        __m256d dx = _mm256_sub_pd(_mm256_set1_pd(x[j]), xi);
+        __m256d dy = _mm256_sub_pd(_mm256_set1_pd(y[j]), yi);
+        __m256d dz = _mm256_sub_pd(_mm256_set1_pd(z[j]), zi);
+
+#ifdef __FMA__
+        __m256d r2 = _mm256_fmadd_pd(dx, dx,
+                     _mm256_fmadd_pd(dy, dy, _mm256_mul_pd(dz, dz)));
+#else
+        __m256d r2 = _mm256_add_pd(_mm256_mul_pd(dx, dx),
+                     _mm256_add_pd(_mm256_mul_pd(dy, dy),
+                                   _mm256_mul_pd(dz, dz)));
+#endif
+
+        /* GM_j / r^3, zeroed in the lane where j is the target itself */
+        __m256d inv_r = _mm256_div_pd(_mm256_set1_pd(1.0), _mm256_sqrt_pd(r2));
+        __m256d s = _mm256_mul_pd(_mm256_set1_pd(gm[j]),
+                    _mm256_mul_pd(inv_r, _mm256_mul_pd(inv_r, inv_r)));
+        s = _mm256_andnot_pd(_mm256_castsi256_pd(
+                _mm256_cmpeq_epi64(lanes, _mm256_set1_epi64x(j))), s);
+
+#ifdef __FMA__
+        ax = _mm256_fmadd_pd(s, dx, ax);
+        ay = _mm256_fmadd_pd(s, dy, ay);
+        az = _mm256_fmadd_pd(s, dz, az);
+#else
+        ax = _mm256_add_pd(ax, _mm256_mul_pd(s, dx));
+        ay = _mm256_add_pd(ay, _mm256_mul_pd(s, dy));
+        az = _mm256_add_pd(az, _mm256_mul_pd(s, dz));
+#endif
+    }
+
+    _mm256_storeu_pd(res[0], ax);
+    _mm256_storeu_pd(res[1], ay);
+    _mm256_storeu_pd(res[2], az);
+
+    for (l = 0; l < 4; l++) {
+        out[3 * (i + l) + 0] = res[0][l];
+        out[3 * (i + l) + 1] = res[1][l];
+        out[3 * (i + l) + 2] = res[2][l];
+    }
+}
+
+/* xj minus the eight targets in lo and hi, rounded to single precision */
+static inline __m256 sub_to_ps(__m256d xj, __m256d lo, __m256d hi)
+{
+    return _mm256_insertf128_ps(
+               _mm256_castps128_ps256(_mm256_cvtpd_ps(_mm256_sub_pd(xj, lo))),
+               _mm256_cvtpd_ps(_mm256_sub_pd(xj, hi)), 1);
+}
+
+static inline void accel_block8_f32(ptrdiff_t i, ptrdiff_t n,
+                                    const double *x, const double *y,
+                                    const double *z, const float *gm,
+                                    double *out)
+{
+    const __m256 zero = _mm256_setzero_ps();
+    const __m256d xlo = _mm256_loadu_pd(&x[i]), xhi = _mm256_loadu_pd(&x[i + 4]);
+    const __m256d ylo = _mm256_loadu_pd(&y[i]), yhi = _mm256_loadu_pd(&y[i + 4]);
+    const __m256d zlo = _mm256_loadu_pd(&z[i]), zhi = _mm256_loadu_pd(&z[i + 4]);
+    const __m256i lanes = _mm256_add_epi32(_mm256_set1_epi32((int)i),
+                          _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7));
+
+    __m256 ax = zero, ay = zero, az = zero;
+    float res[3][8];
+    ptrdiff_t j;
+    int l;
+
+    for (j = 0; j < n; j++) {
+        __m256 dx = sub_to_ps(_mm256_set1_pd(x[j]), xlo, xhi);
+        __m256 dy = sub_to_ps(_mm256_set1_pd(y[j]), ylo, yhi);
+        __m256 dz = sub_to_ps(_mm256_set1_pd(z[j]), zlo, zhi);
+
+#ifdef __FMA__
+        __m256 r2 = _mm256_fmadd_ps(dx, dx,
+                    _mm256_fmadd_ps(dy, dy, _mm256_mul_ps(dz, dz)));
+#else
+        __m256 r2 = _mm256_add_ps(_mm256_mul_ps(dx, dx),
+                    _mm256_add_ps(_mm256_mul_ps(dy, dy),
+                                  _mm256_mul_ps(dz, dz)));
+#endif
+
+        /* GM_j / r^2 times the unit vector stays within the normal range
+           of a float where 1 / r^3 underflows at solar system distances.
+           1 / r is zeroed in the lane where j is the target itself. */
+        __m256 inv_r = _mm256_div_ps(_mm256_set1_ps(1.0f), _mm256_sqrt_ps(r2));
+        inv_r = _mm256_andnot_ps(_mm256_castsi256_ps(
+                _mm256_cmpeq_epi32(lanes, _mm256_set1_epi32((int)j))), inv_r);
+        __m256 s = _mm256_mul_ps(_mm256_set1_ps(gm[j]), _mm256_mul_ps(inv_r, inv_r));
+        dx = _mm256_mul_ps(dx, inv_r);
+        dy = _mm256_mul_ps(dy, inv_r);
+        dz = _mm256_mul_ps(dz, inv_r);
+
+#ifdef __FMA__
+        ax = _mm256_fmadd_ps(s, dx, ax);
+        ay = _mm256_fmadd_ps(s, dy, ay);
+        az = _mm256_fmadd_ps(s, dz, az);
+#else
+        ax = _mm256_add_ps(ax, _mm256_mul_ps(s, dx));
+        ay = _mm256_add_ps(ay, _mm256_mul_ps(s, dy));
+        az = _mm256_add_ps(az, _mm256_mul_ps(s, dz));
+#endif
+    }
+
+    _mm256_storeu_ps(res[0], ax);
+    _mm256_storeu_ps(res[1], ay);
+    _mm256_storeu_ps(res[2], az);
+
+    for (l = 0; l < 8; l++) {
+        out[3 * (i + l) + 0] = res[0][l];
+        out[3 * (i + l) + 1] = res[1][l];
+        out[3 * (i + l) + 2] = res[2][l];
+    }
+}
+
+#else
+
+#define ORBIT_HAVE_AVX2 0
+
+static inline void accel_block4(ptrdiff_t i, ptrdiff_t n,
+                                const double *x, const double *y,
+                                const double *z, const double *gm,
+                                double *out)
+{
+    ptrdiff_t t, j, k;
+
+    for (t = i; t < i + 4; t++) {
+        double ax = 0.0, ay = 0.0, az = 0.0;
+
+        /* A body exerts no acceleration on itself, so step over j == t */
+        for (k = 0; k < n - 1; k++) {
+            double dx, dy, dz, r2, s;
+
+            j = k + (k >= t);
+
+            dx = x[j] - x[t];
+            dy = y[j] - y[t];
+            dz = z[j] - z[t];
+
+            r2 = dx * dx + dy * dy + dz * dz;
+            s = gm[j] * pow(r2, -1.5);
+
+            ax += s * dx;
+            ay += s * dy;
+            az += s * dz;
+        }
+
+        out[3 * t + 0] = ax;
+        out[3 * t + 1] = ay;
+        out[3 * t + 2] = az;
+    }
+}
+
+static inline void accel_block8_f32(ptrdiff_t i, ptrdiff_t n,
+                                    const double *x, const double *y,
+                                    const double *z, const float *gm,
+                                    double *out)
+{
+    ptrdiff_t t, j, k;
+
+    for (t = i; t < i + 8; t++) {
+        float ax = 0.0f, ay = 0.0f, az = 0.0f;
+
+        /* A body exerts no acceleration on itself, so step over j == t */
+        for (k = 0; k < n - 1; k++) {
+            float dx, dy, dz, inv_r, s;
+
+            j = k + (k >= t);
+
+            dx = (float)(x[j] - x[t]);
+            dy = (float)(y[j] - y[t]);
+            dz = (float)(z[j] - z[t]);
+
+            inv_r = 1.0f / sqrtf(dx * dx + dy * dy + dz * dz);
+            s = gm[j] * (inv_r * inv_r);
+
+            ax += s * (dx * inv_r);
+            ay += s * (dy * inv_r);
+            az += s * (dz * inv_r);
+        }
+
+        out[3 * t + 0] = ax;
+        out[3 * t + 1] = ay;
+        out[3 * t + 2] = az;
+    }
+}
+
+#endif
+
+#endif
@@ -0,0 +1,82 @@
+#     Solar system simulator. Copyright (c) 2017 Mads M. Hansen
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""CUDA kernels for the accelerations of large systems held on the GPU"""
+
+from numba import cuda, float64
+
+# Number of threads per block, and of source bodies staged in shared memory
+TILE = 128
+
+
+@cuda.jit(fastmath=True)
+def _accel_kernel(pos, gm, out):
+    """One thread per target body i, walking the source bodies in tiles
+    of TILE staged through shared memory by the whole block"""
+
+    sh_pos = cuda.shared.array(shape=(TILE, 3), dtype=float64)
+    sh_gm = cuda.shared.array(shape=TILE, dtype=float64)
+
+    n = pos.shape[0]
+    i = cuda.grid(1)
+    t = cuda.threadIdx.x
+
+    xi = 0.0
+    yi = 0.0
+    zi = 0.0
+    if i < n:
+        xi = pos[i, 0]
+        yi = pos[i, 1]
+        zi = pos[i, 2]
+
+    ax = 0.0
+    ay = 0.0
+    az = 0.0
+
+    for start in range(0, n, TILE):
+        # Every thread of the block loads one source body of the tile
+        j = start + t
+        if j < n:
+            sh_pos[t, 0] = pos[j, 0]
+            sh_pos[t, 1] = pos[j, 1]
+            sh_pos[t, 2] = pos[j, 2]
+            sh_gm[t] = gm[j]
+        cuda.syncthreads()
+
+        for k in range(min(TILE, n - start)):
+            # A body exerts no acceleration on itself
+            if start + k != i:
+                dx = sh_pos[k, 0] - xi
+                dy = sh_pos[k, 1] - yi
+                dz = sh_pos[k, 2] - zi
+
+                s = sh_gm[k] * (dx * dx + dy * dy + dz * dz) ** -1.5
+                ax += s * dx
+                ay += s * dy
+                az += s * dz
+        cuda.syncthreads()
+
+    if i < n:
+        out[i, 0] = ax
+        out[i, 1] = ay
+        out[i, 2] = az
+
+
+def accelerations(pos, gm, out):
+    """Writes the n x 3 resultant accelerations for the device arrays
+    pos and gm into the device array out"""
+
+    n = pos.shape[0]
+    blocks = (n + TILE - 1) // TILE
+    _accel_kernel[blocks, TILE](pos, gm, out)
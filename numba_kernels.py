@@ -0,0 +1,437 @@
+#     Solar system simulator. Copyright (c) 2017 Mads M. Hansen
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Numba compiled kernels for the integration of the solar system"""
+
+import functools
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(inline='always', fastmath=True)
+def _accelerations(n, pos, gm, out):
+    """Body of accelerations for n bodies, inlined into its callers so that
+    a compile time constant n reaches the loops"""
+
+    for i in range(n):
+        for c in range(3):
+            out[i, c] = 0.0
+
+    # Every pair is visited once: by Newton's third law the pull of j on i
+    # and of i on j share 1 / |r_ij|^3 and differ only in GM and sign
+    for i in range(n):
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+
+        for j in range(i + 1, n):
+            dx = pos[j, 0] - pos[i, 0]
+            dy = pos[j, 1] - pos[i, 1]
+            dz = pos[j, 2] - pos[i, 2]
+
+            inv_d3 = (dx * dx + dy * dy + dz * dz) ** -1.5
+
+            s = gm[j] * inv_d3
+            ax += s * dx
+            ay += s * dy
+            az += s * dz
+
+            s = gm[i] * inv_d3
+            out[j, 0] -= s * dx
+            out[j, 1] -= s * dy
+            out[j, 2] -= s * dz
+
+        out[i, 0] += ax
+        out[i, 1] += ay
+        out[i, 2] += az
+
+
+@njit(inline='always', fastmath=True)
+def _accelerations_f32(n, i, axes, gm, out):
+    """Single precision acceleration on the target body i. The separations
+    are formed in double precision from the float64 positions laid out per
+    axis in the 3 x n array axes, the distances and the sum over j are
+    computed in float32 with the float32 gm.
+
+    Unlike _accelerations every pair is visited twice: the full loop over j
+    is vectorised over eight float32 lanes, which outweighs the halved
+    pair count of Newton's third law."""
+
+    xi = axes[0, i]
+    yi = axes[1, i]
+    zi = axes[2, i]
+
+    ax = np.float32(0.0)
+    ay = np.float32(0.0)
+    az = np.float32(0.0)
+
+    for j in range(n):
+        dx = np.float32(axes[0, j] - xi)
+        dy = np.float32(axes[1, j] - yi)
+        dz = np.float32(axes[2, j] - zi)
+
+        # A power rather than a division, which Numba guards against zero
+        # and so keeps from being vectorised. 1 / r is zeroed for j == i.
+        inv_r = (dx * dx + dy * dy + dz * dz) ** np.float32(-0.5)
+        inv_r = inv_r if j != i else np.float32(0.0)
+
+        # GM / r^2 times the unit vector keeps every intermediate in
+        # the normal range of a float, where 1 / r^3 underflows
+        s = gm[j] * (inv_r * inv_r)
+        ax += s * (dx * inv_r)
+        ay += s * (dy * inv_r)
+        az += s * (dz * inv_r)
+
+    out[i, 0] = ax
+    out[i, 1] = ay
+    out[i, 2] = az
+
+
+@njit(cache=True, fastmath=True)
+def accelerations(pos, gm, out):
+    """Writes the n x 3 resultant accelerations for the positions
+    pos and gravitational parameters gm into out"""
+    _accelerations(pos.shape[0], pos, gm, out)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def accelerations_parallel(pos, gm, out):
+    """Multithreaded variant of accelerations. Every thread owns the rows
+    it writes, so the full sum over j is done for each target i."""
+
+    n = pos.shape[0]
+
+    for i in prange(n):
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+
+        # A body exerts no acceleration on itself, so step over j == i
+        for k in range(n - 1):
+            j = k + (k >= i)
+
+            dx = pos[j, 0] - pos[i, 0]
+            dy = pos[j, 1] - pos[i, 1]
+            dz = pos[j, 2] - pos[i, 2]
+
+            s = gm[j] * (dx * dx + dy * dy + dz * dz) ** -1.5
+            ax += s * dx
+            ay += s * dy
+            az += s * dz
+
+        out[i, 0] = ax
+        out[i, 1] = ay
+        out[i, 2] = az
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def accelerations_parallel_f32(axes, gm, out):
+    """Single precision variant of accelerations_parallel for the 3 x n
+    float64 positions axes and float32 gm, see _accelerations_f32"""
+
+    n = axes.shape[1]
+
+    for i in prange(n):
+        _accelerations_f32(n, i, axes, gm, out)
+
+
+@njit(inline='always', fastmath=True)
+def _step_accelerations(n, pos, axes, gm, gm_f32, out, parallel, single):
+    """Dispatches to the acceleration kernel selected by parallel and
+    single. The single precision kernels read the positions from axes."""
+
+    if single:
+        if parallel:
+            accelerations_parallel_f32(axes, gm_f32, out)
+        else:
+            for i in range(n):
+                _accelerations_f32(n, i, axes, gm_f32, out)
+    elif parallel:
+        accelerations_parallel(pos, gm, out)
+    else:
+        _accelerations(n, pos, gm, out)
+
+
+@njit(inline='always', fastmath=True)
+def _verlet(n, pos, vel, gm, dt, traj_pos, traj_vel, parallel, single):
+    """Body of verlet for n bodies, inlined into its callers so that
+    a compile time constant n reaches the acceleration loops"""
+
+    rows = traj_pos.shape[0]
+
+    a = np.empty((n, 3))
+    half_dt = 0.5 * dt
+
+    # Per axis copy of the positions and float32 GMs for the single
+    # precision kernels
+    axes = np.ascontiguousarray(pos.T)
+    gm_f32 = gm.astype(np.float32)
+
+    # Save the initial positions and velocities
+    traj_pos[0] = pos
+    traj_vel[0] = vel
+
+    _step_accelerations(n, pos, axes, gm, gm_f32, a, parallel, single)
+
+    for k in range(1, rows):
+        # Half kick and drift, storing the new position in the same pass
+        for i in range(n):
+            for c in range(3):
+                v = vel[i, c] + half_dt * a[i, c]
+                p = pos[i, c] + v * dt
+                vel[i, c] = v
+                pos[i, c] = p
+                traj_pos[k, i, c] = p
+                if single:
+                    axes[c, i] = p
+
+        # Get new acceleration
+        _step_accelerations(n, pos, axes, gm, gm_f32, a, parallel, single)
+
+        # Second half kick, storing the new velocity in the same pass
+        for i in range(n):
+            for c in range(3):
+                v = vel[i, c] + half_dt * a[i, c]
+                vel[i, c] = v
+                traj_vel[k, i, c] = v
+
+
+@njit(cache=True, fastmath=True)
+def verlet(pos, vel, gm, dt, traj_pos, traj_vel, parallel, single):
+    """Integrates the system with the velocity Verlet method, advancing pos
+    and vel in place and saving every step into the rows x n x 3 arrays
+    traj_pos and traj_vel. parallel selects the multithreaded kernel and
+    single the single precision accelerations."""
+    _verlet(pos.shape[0], pos, vel, gm, dt, traj_pos, traj_vel, parallel, single)
+
+
+@functools.lru_cache(maxsize=None)
+def make_verlet(n, single=False):
+    """Returns the serial verlet compiled for exactly n bodies. Numba
+    freezes the captured n and single as constants, so the acceleration
+    loops have known trip counts and can be fully unrolled for small
+    systems. The compiled code is cached on disk per n and single."""
+
+    @njit(cache=True, fastmath=True)
+    def verlet_n(pos, vel, gm, dt, traj_pos, traj_vel):
+        _verlet(n, pos, vel, gm, dt, traj_pos, traj_vel, False, single)
+
+    return verlet_n
+
+
+# Leaves are split until their half width drops below this fraction of the
+# root half width; bodies closer than that share a leaf
+MIN_HALF_WIDTH = 2.0 ** -40
+
+
+@njit(cache=True)
+def _grow(a, fill):
+    """Returns a copy of the array a with twice as many rows,
+    the new rows set to fill"""
+    b = np.full((2 * a.shape[0],) + a.shape[1:], fill, dtype=a.dtype)
+    b[:a.shape[0]] = a
+    return b
+
+
+@njit(cache=True)
+def build_octree(pos, gm):
+    """Builds a Barnes-Hut octree over the positions pos as flat arrays.
+
+    Returns (n_nodes, children, first, following, center, half, com, node_gm)
+    where children is a n_nodes x 8 array of child node indices (-1 if absent),
+    first is the first body of a leaf node (-1 for internal and empty nodes),
+    following chains the bodies sharing a leaf (-1 terminates), center and
+    half are the center and half width of the cell and com, node_gm the
+    center of mass and the summed gravitational parameter of the node."""
+
+    n = pos.shape[0]
+
+    # Bounding cube of all bodies
+    lo = np.empty(3)
+    hi = np.empty(3)
+    for c in range(3):
+        lo[c] = pos[:, c].min()
+        hi[c] = pos[:, c].max()
+
+    capacity = 2 * n + 1
+    children = np.full((capacity, 8), -1, dtype=np.int64)
+    first = np.full(capacity, -1, dtype=np.int64)
+    center = np.empty((capacity, 3))
+    half = np.empty(capacity)
+    following = np.full(n, -1, dtype=np.int64)
+
+    root_half = 0.5 * max(hi[0] - lo[0], hi[1] - lo[1], hi[2] - lo[2])
+    root_half = max(root_half, 1.0) * (1.0 + 1e-9)
+    min_half = root_half * MIN_HALF_WIDTH
+    for c in range(3):
+        center[0, c] = 0.5 * (lo[c] + hi[c])
+    half[0] = root_half
+    n_nodes = 1
+
+    # The root starts out as a leaf holding the first body
+    first[0] = 0
+
+    for b in range(1, n):
+        node = 0
+        while True:
+            if first[node] != -1:
+                if half[node] < min_half:
+                    # Too close to be separated, share the leaf
+                    following[b] = first[node]
+                    first[node] = b
+                    break
+
+                # Occupied leaf, push its bodies one level down
+                occupant = first[node]
+                first[node] = -1
+
+                if n_nodes + 1 > children.shape[0]:
+                    children = _grow(children, -1)
+                    first = _grow(first, -1)
+                    center = _grow(center, 0.0)
+                    half = _grow(half, 0.0)
+
+                o = 0
+                for c in range(3):
+                    if pos[occupant, c] >= center[node, c]:
+                        o |= 1 << c
+                child = n_nodes
+                n_nodes += 1
+                children[node, o] = child
+                first[child] = occupant
+                half[child] = 0.5 * half[node]
+                for c in range(3):
+                    sign = 1.0 if (o >> c) & 1 else -1.0
+                    center[child, c] = center[node, c] + sign * half[child]
+
+            # Internal node, descend into the octant of body b
+            o = 0
+            for c in range(3):
+                if pos[b, c] >= center[node, c]:
+                    o |= 1 << c
+
+            if children[node, o] == -1:
+                if n_nodes + 1 > children.shape[0]:
+                    children = _grow(children, -1)
+                    first = _grow(first, -1)
+                    center = _grow(center, 0.0)
+                    half = _grow(half, 0.0)
+
+                child = n_nodes
+                n_nodes += 1
+                children[node, o] = child
+                first[child] = b
+                half[child] = 0.5 * half[node]
+                for c in range(3):
+                    sign = 1.0 if (o >> c) & 1 else -1.0
+                    center[child, c] = center[node, c] + sign * half[child]
+                break
+
+            node = children[node, o]
+
+    # Children are always created after their parents, so a reverse sweep
+    # accumulates the centers of mass bottom-up
+    com = np.zeros((n_nodes, 3))
+    node_gm = np.zeros(n_nodes)
+    for node in range(n_nodes - 1, -1, -1):
+        b = first[node]
+        while b != -1:
+            node_gm[node] += gm[b]
+            for c in range(3):
+                com[node, c] += gm[b] * pos[b, c]
+            b = following[b]
+
+        for o in range(8):
+            child = children[node, o]
+            if child != -1:
+                node_gm[node] += node_gm[child]
+                for c in range(3):
+                    com[node, c] += node_gm[child] * com[child, c]
+
+        if node_gm[node] > 0.0:
+            for c in range(3):
+                com[node, c] /= node_gm[node]
+
+    return n_nodes, children, first, following, center, half, com, node_gm
+
+
+@njit(cache=True, fastmath=True)
+def bh_accelerations(pos, gm, theta, out):
+    """Writes the n x 3 resultant accelerations into out using a Barnes-Hut
+    octree. Cells of width w at distance d are approximated by their center
+    of mass when w < theta * d and the cell does not contain the target;
+    theta = 0 reproduces the direct sum."""
+
+    n = pos.shape[0]
+    n_nodes, children, first, following, center, half, com, node_gm = build_octree(pos, gm)
+
+    theta2 = theta * theta
+    stack = np.empty(n_nodes, dtype=np.int64)
+
+    for i in range(n):
+        ax = 0.0
+        ay = 0.0
+        az = 0.0
+
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+
+            if first[node] != -1:
+                # Leaf, sum its bodies directly
+                b = first[node]
+                while b != -1:
+                    # A body exerts no acceleration on itself
+                    if b != i:
+                        dx = pos[b, 0] - pos[i, 0]
+                        dy = pos[b, 1] - pos[i, 1]
+                        dz = pos[b, 2] - pos[i, 2]
+                        s = gm[b] * (dx * dx + dy * dy + dz * dz) ** -1.5
+                        ax += s * dx
+                        ay += s * dy
+                        az += s * dz
+                    b = following[b]
+                continue
+
+            dx = com[node, 0] - pos[i, 0]
+            dy = com[node, 1] - pos[i, 1]
+            dz = com[node, 2] - pos[i, 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            w = 2.0 * half[node]
+
+            # A cell holding the target would fold its self interaction
+            # into the pseudo body, however far away the center of mass is
+            inside = (abs(pos[i, 0] - center[node, 0]) <= half[node]
+                      and abs(pos[i, 1] - center[node, 1]) <= half[node]
+                      and abs(pos[i, 2] - center[node, 2]) <= half[node])
+
+            if not inside and w * w < theta2 * d2:
+                # Far enough away to be treated as a single pseudo body
+                s = node_gm[node] * d2 ** -1.5
+                ax += s * dx
+                ay += s * dy
+                az += s * dz
+            else:
+                for o in range(8):
+                    child = children[node, o]
+                    if child != -1:
+                        stack[top] = child
+                        top += 1
+
+        out[i, 0] = ax
+        out[i, 1] = ay
+        out[i, 2] = az
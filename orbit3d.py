@@ -19,234 +19,265 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import read_phys_properties as npp
 
+try:
+    import numba_kernels
+except ImportError:
+    numba_kernels = None
+
+# Native OpenMP kernel, built with: python setup.py build_ext --inplace
+try:
+    import _orbit_kernel
+except ImportError:
+    _orbit_kernel = None
+
+# GPU kernels for systems held in cupy arrays
+try:
+    import cuda_kernels
+except ImportError:
+    cuda_kernels = None
+
 
 class System:
-    def __init__(self, names, posvel, gms, radii):
-        """Accepts arrays of initial properties for celestial bodies"""
+    def __init__(self, names, posvel, gms, radii, dtype=np.float64, xp=np):
+        """Accepts arrays of initial properties for celestial bodies.
+        dtype selects the floating point precision of the force evaluation and
+        xp the array module holding the state, numpy or cupy for the GPU.
+        GPU systems need numba.cuda and only support direct summation
+        in float64.
+
+        The state is always kept in float64. With np.float32 the separations
+        between bodies are formed in float64 and only the distances and the
+        sums over the bodies are computed in float32, so positions of
+        ~1e12 m keep their resolution. Barnes-Hut requires float64."""
 
         self.n = len(names)
+        self.dtype = np.dtype(dtype)
+        self.xp = xp
+
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError('dtype must be np.float32 or np.float64')
+
+        posvel = np.asarray(posvel, dtype=np.float64)
+
+        # State of the system as contiguous n x 3 arrays of
+        # positions (m) and velocities (m/s)
+        self.pos = xp.array(posvel[:, 0:3])
+        self.vel = xp.array(posvel[:, 3:6])
+
+        # Gravitational parameters (m^3 s^-2) and radii (m)
+        self.gm = xp.array(gms, dtype=np.float64)
+        self.radii = xp.array(radii, dtype=np.float64)
+
+        # Names of the bodies, row i of every array above is body names[i]
+        self.names = list(names)
 
-        # Initialize the bodies in our solar system
-        self.bodies = [Body(names[i], *posvel[i], gms[i], radii[i]) for i in
-                       range(self.n)]
+        # Force evaluation, 'direct' sums all pairs while 'bh' uses a
+        # Barnes-Hut octree with opening angle theta
+        self.force_mode = 'direct'
+        self.theta = 0.5
+
+        # Evaluate the direct sum on all cores, pays off for large n
+        self.parallel = False
 
     def get_positions(self):
         """Returns a n x 3 array with position coordinates"""
-        pos = np.zeros(shape=(self.n, 3))
-        for b, i in zip(self.bodies, range(self.n)):
-            pos[i][:] = b.get_position()
-        return pos
+        return self.pos.copy()
 
     def get_velocities(self):
         """Returns a n x 3 array with velocities"""
-        vel = np.zeros(shape=(self.n, 3))
-        for b, i in zip(self.bodies, range(self.n)):
-            vel[i][:] = b.get_velocity()
-        return vel
+        return self.vel.copy()
 
     def set_positions(self, pos):
         """Accepts a n x 3 array with coordinates (x, y, z)"""
-        for a, i in zip(self.bodies, range(self.n)):
-            a.set_position(*pos[i][:])
+        self.pos[:] = pos
 
     def set_velocities(self, vel):
         """Accepts a n x 3 array with velocities (vx, vy, vz) and
-        updates the positions of all bodies in this solar system"""
-        for a, i in zip(self.bodies, range(self.n)):
-            a.set_position(*vel[i][:])
+        updates the velocities of all bodies in this solar system"""
+        self.vel[:] = vel
 
     def get_accelerations(self):
-        """Returns n x n array of the resultant accelerations in the system"""
-
-        def acceleration(body1, body2):
-            """Vector acceleration (in ms^-2) acting on body2 exerted by body1"""
-
-            pos1 = body1.get_position()
-            pos2 = body2.get_position()
-
-            # Avoid a divide by zero
-            if np.array_equal(pos2, pos1):
-                return np.zeros(3)
-
-            # Distance vector
-            r12 = pos2 - pos1
-            dist = np.linalg.norm(r12)
-
-            return -body1.GM / (dist ** 3) * r12
-
-        # Array to hold the force vectors
-        accelerations = np.zeros(shape=(self.n, self.n, 3))
-
-        # Calculate the force vectors and insert them into the array
-        for a, i in zip(self.bodies, range(self.n)):
-            for b, j in zip(self.bodies, range(self.n)):
-                accelerations[i][j][:] = acceleration(a, b)
-
-        accelerations = accelerations.sum(axis=0)
-
-        return accelerations
-
-class Body:
-    """A celestial body class, with all initial values in SI units """
-
-
-    def __init__(self, name, x0, y0, z0, vx0, vy0, vz0, gm, radius):
-
-        # Gravitational parameter
-        self.GM = gm
-
-        # Name of the body (string)
-        self.name = name
-
-        # Initial position of the body (m)
-        self.x0 = x0
-        self.y0 = y0
-        self.z0 = z0
-
-        # Position (m). Set to initial value.
-        self.x = self.x0
-        self.y = self.y0
-        self.z = self.z0
-
-        # Initial velocity of the body (m/s)
-        self.vx0 = vx0
-        self.vy0 = vy0
-        self.vz0 = vz0
-
-        # Velocity (m/s). Set to initial value.
-        self.vx = self.vx0
-        self.vy = self.vy0
-        self.vz = self.vz0
-
-        # Radius of the body (m)
-        self.radius = radius
-
-    def get_position(self):
-        """Returns 1 x 3 array with the x, y, x positions"""
-        return np.array([self.x, self.y, self.z])
-
-    def get_velocity(self):
-        """Returns a 1 x 3 array of velocities"""
-        return np.array([self.vx, self.vy, self.vz])
-
-    def set_position(self, x, y, z):
-        """Set the position"""
-        self.x = x
-        self.y = y
-        self.z = z
-
-    def set_velocity(self, vx, vy, vz):
-        """Set the velocity"""
-        self.vx = vx
-        self.vy = vy
-        self.vz = vz
+        """Returns n x 3 array of the resultant accelerations in the system"""
+
+        if self.xp is not np:
+            # The CPU kernels below cannot read GPU arrays
+            if cuda_kernels is None:
+                raise ImportError('GPU force evaluation requires numba.cuda')
+            if self.force_mode != 'direct':
+                raise ValueError('Barnes-Hut force evaluation is not available on the GPU')
+            if self.dtype != np.float64:
+                raise ValueError('GPU force evaluation requires float64')
+
+            accelerations = self.xp.empty(shape=(self.n, 3))
+            cuda_kernels.accelerations(self.pos, self.gm, accelerations)
+            return accelerations
+
+        if self.force_mode == 'bh':
+            if numba_kernels is None:
+                raise ImportError('Barnes-Hut force evaluation requires Numba')
+            if self.dtype != np.float64:
+                raise ValueError('Barnes-Hut force evaluation requires float64')
+            if not self.theta >= 0:
+                raise ValueError('theta must be non-negative, got %r' % self.theta)
+
+            accelerations = np.empty(shape=(self.n, 3))
+            numba_kernels.bh_accelerations(self.pos, self.gm, self.theta, accelerations)
+            return accelerations
+
+        single = self.dtype == np.float32
+
+        if self.parallel and numba_kernels is not None:
+            accelerations = np.empty(shape=(self.n, 3))
+            if single:
+                numba_kernels.accelerations_parallel_f32(np.ascontiguousarray(self.pos.T),
+                                                         self.gm.astype(np.float32),
+                                                         accelerations)
+            else:
+                numba_kernels.accelerations_parallel(self.pos, self.gm, accelerations)
+            return accelerations
+
+        if _orbit_kernel is not None:
+            accelerations = np.empty(shape=(self.n, 3))
+            if single:
+                compute_accel = _orbit_kernel.compute_accel_f32
+            else:
+                compute_accel = _orbit_kernel.compute_accel
+            compute_accel(np.ascontiguousarray(self.pos), self.gm, accelerations)
+            return accelerations
+
+        if single:
+            return self._direct_accelerations_f32()
+        return self._direct_accelerations()
+
+    def _direct_accelerations(self):
+        """Direct sum of the accelerations with NumPy broadcasting"""
+
+        # Distance vectors r[i, j] = pos[j] - pos[i]
+        r = self.pos[None, :, :] - self.pos[:, None, :]
+        d2 = np.einsum('ijk,ijk->ij', r, r)
+
+        # A body exerts no acceleration on itself
+        np.fill_diagonal(d2, np.inf)
+
+        # Acceleration on body i is the sum of GM_j / |r_ij|^3 * r_ij over j,
+        # with 1 / |r_ij|^3 computed as a single power of the squared distance.
+        # GM_j already is G * m_j, so the source factor is scaled in place
+        # rather than forming G * m_i * m_j per pair.
+        s = d2 ** -1.5
+        s *= self.gm
+
+        # The weighted sum over j as a batched (1 x n) @ (n x 3) product,
+        # one pass without an n x n x 3 temporary
+        return np.matmul(s[:, None, :], r)[:, 0, :]
+
+    def _direct_accelerations_f32(self):
+        """Single precision variant of _direct_accelerations"""
+
+        # Separations in float64, everything after in float32
+        r = (self.pos[None, :, :] - self.pos[:, None, :]).astype(np.float32)
+        d2 = np.einsum('ijk,ijk->ij', r, r)
+        np.fill_diagonal(d2, np.inf)
+
+        # GM_j / r^2 times the unit vector r_ij / r keeps every intermediate
+        # in the normal range of a float, where 1 / r^3 underflows
+        inv_r = 1 / np.sqrt(d2)
+        r *= inv_r[:, :, None]
+        s = inv_r * inv_r
+        s *= self.gm.astype(np.float32)
+
+        return np.matmul(s[:, None, :], r)[:, 0, :].astype(np.float64)
 
 
 class Trajectory:
-    """Saves 3-dimensional trajectories and velocities for a number of objects"""
-    def __init__(self, n_trajectories, n_coords):
-        self.trajectories = [np.zeros(shape=(n_coords, 6)) for _ in range(n_trajectories)]
+    """Saves 3-dimensional trajectories and velocities for a number of objects.
+    The rows live in the array module xp of the integrated system; call
+    to_host once after integrating on the GPU."""
+    def __init__(self, n_trajectories, n_coords, dtype=np.float64, xp=np):
+        # Contiguous n_coords x n_trajectories x 3 arrays, one row per step
+        self.xp = xp
+        self.positions = xp.zeros(shape=(n_coords, n_trajectories, 3), dtype=dtype)
+        self.velocities = xp.zeros(shape=(n_coords, n_trajectories, 3), dtype=dtype)
         self.n_trajectories = n_trajectories
         self.row_counter = 0
         self.n_coords = n_coords
 
     def set_trajectory_position(self, pos, vel):
         """Inputs a new position and velocity for every object from two n x 3 arrays"""
-        for i in range(self.n_trajectories):
-            self.trajectories[i][self.row_counter][0:3] = pos[i]
-            self.trajectories[i][self.row_counter][3:7] = vel[i]
+        self.positions[self.row_counter] = pos
+        self.velocities[self.row_counter] = vel
 
         self.row_counter += 1
 
-
     def get_trajectory(self, i):
-        """Returns array i"""
-        return self.trajectories[i]
+        """Returns the n_coords x 3 positions of object i"""
+        return self.positions[:, i, :]
 
     def get_position_at_index(self, i):
-        """Gets the positions of all objects at index i
+        """Gets the positions and velocities of all objects at index i
            as a n x 6 array"""
+        return self.xp.hstack((self.positions[i], self.velocities[i]))
 
-        data = np.zeros(shape=(self.n_trajectories, 6))
-
-        for t, j in zip(self.trajectories, range(self.n_trajectories)):
-            data[j] = t[i]
-
-        return data
-
-
-body_names, body_radii, body_gms = npp.read_phys_properties()
-
-n_bodies = len(body_names)
+    def to_host(self):
+        """Moves the trajectories to NumPy arrays in a single copy"""
+        if self.xp is not np:
+            self.positions = self.xp.asnumpy(self.positions)
+            self.velocities = self.xp.asnumpy(self.velocities)
+            self.xp = np
 
-# Construct list of initial positions and velocities for each body (m and m/s)
-init_pos_vel = np.zeros(shape=(n_bodies, 6))
-
-for _, __ in zip(body_names, range(n_bodies)):
-    init_pos_vel[__][:] = read_horizon.readdata(_.lower())[0]
-
-# Solar system instance
-detail = 64
-dt = 86400/detail
-n_rows = 1131*detail
-
-sol = System(body_names, init_pos_vel, body_gms, body_radii)
-tra = Trajectory(len(body_names), n_rows)
 
 # Verlet
 
 
 def verlet(system, trajectory, rows, delta_t):
 
-    delta_t2 = delta_t ** 2
-
-    for k in range(rows):
-        if k == 0:
-            # Get initial positions and velocities
-            q0 = system.get_positions()
-            p0 = system.get_velocities()
-
-            # Save to trajectory
-            trajectory.set_trajectory_position(q0, p0)
-
+    # The compiled kernel writes into a slice of the trajectory without
+    # bounds checks, so make sure all rows fit before integrating
+    start = trajectory.row_counter
+    if rows < 1 or start + rows > trajectory.n_coords:
+        raise IndexError('cannot store %d rows from row %d in a trajectory of %d rows'
+                         % (rows, start, trajectory.n_coords))
+
+    # Every step is stored where the state lives, GPU systems need a GPU trajectory
+    if trajectory.xp is not system.xp:
+        raise ValueError('the trajectory and the system use different array modules')
+
+    if numba_kernels is not None and system.force_mode == 'direct' and system.xp is np:
+        # Let the kernel write straight into the trajectory rows
+        q = trajectory.positions[start:start + rows]
+        p = trajectory.velocities[start:start + rows]
+        single = system.dtype == np.float32
+
+        if system.parallel:
+            numba_kernels.verlet(system.pos, system.vel, system.gm, delta_t, q, p, True, single)
         else:
-            # Get previous position and velocities
-            q0 = trajectory.get_position_at_index(k-1)[:, 0:3]
-            p0 = trajectory.get_position_at_index(k-1)[:, 3:7]
-
-            # Calculate acceleration
-            a0 = system.get_accelerations()
+            verlet_n = numba_kernels.make_verlet(system.n, single)
+            verlet_n(system.pos, system.vel, system.gm, delta_t, q, p)
 
-            # Calculate q1
-            q1 = q0 + p0 * delta_t + 0.5 * a0 * delta_t2
+        trajectory.row_counter += rows
+        return
 
-            # Update positions of the planets
-            system.set_positions(q1)
+    # Save the initial positions and velocities
+    trajectory.set_trajectory_position(system.pos, system.vel)
 
-            # Get new acceleration
-            a1 = system.get_accelerations()
+    a = system.get_accelerations()
 
-            # Calculate new velocity
-            p1 = p0 + (a0+a1)/2 * delta_t
+    for k in range(1, rows):
+        # Velocity Verlet: half kick, drift, new acceleration, half kick
+        system.vel += 0.5 * a * delta_t
+        system.pos += system.vel * delta_t
 
-            # Save to trajectory
-            trajectory.set_trajectory_position(q1, p1)
+        a = system.get_accelerations()
 
-verlet(sol, tra, n_rows, dt)
+        system.vel += 0.5 * a * delta_t
 
-# Plot the orbits
+        # Save to trajectory
+        trajectory.set_trajectory_position(system.pos, system.vel)
 
-fig = plt.figure()
-ax = fig.gca(projection='3d')
 
-# venus = read_horizon.readdiagnosticdata('venus')
-# luna_diagnostic = read_horizon.readdiagnosticdata('luna')
-
-
-def diangnostic():
+def diangnostic(trajectory, detail):
     earth_diagnostic = read_horizon.readdiagnosticdata('earth')[:, 0:3]
-    earth_sim = tra.get_trajectory(3)[:, 0:3]
-    sun_sim = tra.get_trajectory(0)[:, 0:3]
+    earth_sim = trajectory.get_trajectory(3)[:, 0:3]
+    sun_sim = trajectory.get_trajectory(0)[:, 0:3]
 
     # Coordinates of sim earth with respect to the sun
     earth_new_coords = (earth_sim - sun_sim)[::detail, :]
@@ -263,17 +294,53 @@ def diangnostic():
     # print(list(zip(body_names, body_gms)))
 
 
-diangnostic()
+def main():
+    body_names, body_radii, body_gms = npp.read_phys_properties()
+
+    n_bodies = len(body_names)
+
+    # Construct list of initial positions and velocities for each body (m and m/s)
+    init_pos_vel = np.empty(shape=(n_bodies, 6))
+
+    for _, __ in zip(body_names, range(n_bodies)):
+        init_pos_vel[__][:] = read_horizon.readdata(_.lower())[0]
+
+    # Solar system instance
+    detail = 64
+    dt = 86400/detail
+    n_rows = 1131*detail
+
+    sol = System(body_names, init_pos_vel, body_gms, body_radii)
+    tra = Trajectory(len(body_names), n_rows)
+
+    verlet(sol, tra, n_rows, dt)
+
+    # Plot the orbits
+
+    fig = plt.figure()
+    ax = fig.gca(projection='3d')
+
+    # venus = read_horizon.readdiagnosticdata('venus')
+    # luna_diagnostic = read_horizon.readdiagnosticdata('luna')
+
+    diangnostic(tra, detail)
+
+    # Plot every fifth day, the orbits look the same at a fifth of the points
+    plot_stride = 5 * detail
+
+    for j in range(n_bodies):
+        orbit = tra.get_trajectory(j)[::plot_stride]
+        ax.plot(orbit[:, 0], orbit[:, 1], orbit[:, 2], label=sol.names[j])
+
+    # ax.plot(venus[:, 0], venus[:, 1], venus[:, 2], label='Venus diagnostic')
+    # ax.plot(earth[:, 0], earth[:, 1], earth[:, 2], label='Earth diagnostic')
+    # ax.plot(luna_diagnostic[:, 0], luna_diagnostic[:, 1], luna_diagnostic[:, 2], label='Luna diagnostic')
 
-for j in range(n_bodies):
-    ax.plot(tra.get_trajectory(j)[::detail, 0], tra.get_trajectory(j)[::detail, 1],
-            tra.get_trajectory(j)[::detail, 2], label=body_names[j])
+    dim = 1e12
+    ax.auto_scale_xyz([-dim, dim], [-dim, dim], [-dim, dim])
+    plt.legend()
+    plt.show()
 
-# ax.plot(venus[:, 0], venus[:, 1], venus[:, 2], label='Venus diagnostic')
-# ax.plot(earth[:, 0], earth[:, 1], earth[:, 2], label='Earth diagnostic')
-# ax.plot(luna_diagnostic[:, 0], luna_diagnostic[:, 1], luna_diagnostic[:, 2], label='Luna diagnostic')
 
-dim = 1e12
-ax.auto_scale_xyz([-dim, dim], [-dim, dim], [-dim, dim])
-plt.legend()
-plt.show()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+# Builds the optional native acceleration kernel in place with
+#
+#     python setup.py build_ext --inplace
+
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+openmp_flags = ['-fopenmp']
+
+extensions = [
+    Extension('_orbit_kernel', ['_orbit_kernel.pyx'], depends=['_orbit_simd.h'],
+              extra_compile_args=openmp_flags + ['-O3', '-ffast-math', '-march=native'],
+              extra_link_args=openmp_flags),
+]
+
+setup(name='orbit', ext_modules=cythonize(extensions))